@@ -26,6 +26,10 @@
     - Option for coloring output to be viewed in CraftWare
     - Option to add total number of layers to slice-info block
     - OrcaSlicer: Option to export GCode to be viewed in PrusaSlicer GCode-Viewer.
+    - Option to merge travel moves and remove moves which do nothing
+    - Option to check all moves against bed limits and clips on the build plate
+    - Option to merge several files into one, to print the parts one after another
+    - Option to write statistics per layer and per feature as JSON or CSV
 
     Current behaviour:
     1. Heat up, down nozzle and ooze at your discretion.
@@ -60,10 +64,15 @@ import re
 import argparse
 import configparser
 import ntpath
-from shutil import ReadError, copy2
-from os import path, remove, getenv
+from shutil import copy2, copymode
+from os import path, remove, replace, getenv
 from decimal import Decimal
 import subprocess
+import threading
+import queue
+import json
+import csv
+from itertools import chain
 
 
 def install(package):
@@ -81,6 +90,19 @@ except ImportError:
     import pymsgbox
 
 
+def import_numpy():
+    """ Import NumPy, only needed for the bed and clip check and the statistics.
+    Returns:
+        module: numpy
+    """
+    try:
+        import numpy
+    except ImportError:
+        install("numpy")
+        import numpy
+    return numpy
+
+
 def argumentparser():
     """
         ArgumentParser
@@ -205,6 +227,71 @@ def argumentparser():
                               help='Set progress bar character. '
                               '(Default: %(default)s)')
 
+    # Optimization
+    grp_optimize = parser.add_argument_group('Optimization settings')
+    grp_optimize.add_argument('--optimize', action='store_true', default=False,
+                              help='Merge consecutive travel moves, drop moves to the current position '
+                              'and cancel back-to-back retract/unretract pairs. Extrusion moves are '
+                              'never changed. Fewer commands keep the planner buffer filled on printers '
+                              'fed over a serial line. '
+                              '(Default: %(default)s)')
+
+    # Bed and clip check
+    grp_check = parser.add_argument_group('Bed and clip check settings',
+                                          'The check reads the position of every move, '
+                                          'which makes the run take about twice as long.')
+    grp_check.add_argument('--bed', metavar='x0,y0,x1,y1', type=rectangle,
+                           help='Check that all moves stay within this rectangle of the bed.')
+
+    grp_check.add_argument('--minz', metavar='float', type=float,
+                           help='Check that no move goes below this Z.')
+
+    grp_check.add_argument('--maxz', metavar='float', type=float,
+                           help='Check that no move goes above this Z.')
+
+    grp_check.add_argument('--clip', metavar='x0,y0,x1,y1[,z]', type=rectangle, action='append', default=[],
+                           help='Keep-out rectangle, i.e. a clip on the build plate. Moves must not '
+                           'touch it below height z (optional, default: any height). '
+                           'Can be used more than once. Arcs are checked as straight lines.')
+
+    grp_check.add_argument('--failcheck', action='store_true', default=False,
+                           help='If --failcheck is provided, the export fails if any move '
+                           'violates the bed, Z or clip limits. '
+                           '(Default: %(default)s)')
+
+    # Merge
+    grp_merge = parser.add_argument_group('Merge settings')
+    grp_merge.add_argument('--merge', metavar='OUT', type=str,
+                           help='Merge all gcode-files, in the given order, into file OUT, to print the parts '
+                           'one after another. Keeps start G-Code of the first and end G-Code and configuration '
+                           'of the last file. Layers are numbered over all parts. The gcode-files are not changed. '
+                           'The parts after the first need verbose G-Code, for the move to their first point.')
+
+    grp_merge.add_argument('--clearance', metavar='float', type=float, default=5,
+                           help='Before moving to the next part, lift the nozzle this high (in mm) above '
+                           'the highest part printed so far. (Default: %(default)s)')
+
+    # Statistics
+    grp_stats = parser.add_argument_group('Statistics settings')
+    grp_stats.add_argument('--stats', metavar='FILE', type=str,
+                           help='Write extrusion length, travel distance, number of moves and commands and '
+                           'min/max Z, in total, per layer and per feature (;TYPE:), to FILE. As CSV if FILE ends '
+                           'with .csv, as JSON otherwise. Only extrusion while moving in X/Y counts, retractions '
+                           'do not. Arcs are counted as straight lines. Reads the position of every move, '
+                           'which makes the run take about two and a half times as long; together with the '
+                           'bed and clip check, the positions are read only once.')
+
+    # Pipeline
+    grp_pipeline = parser.add_argument_group('Pipeline settings')
+    grp_pipeline.add_argument('--blocksize', metavar='int', type=positive_int, default=1024,
+                              help='Size of the blocks read from and written to file, in KiB. '
+                              '(Default: %(default)d)')
+
+    grp_pipeline.add_argument('--queuedepth', metavar='int', type=positive_int, default=4,
+                              help='Number of blocks the reader may read ahead and the writer '
+                              'may fall behind. Memory used is about twice this times --blocksize. '
+                              '(Default: %(default)d)')
+
     try:
         args = parser.parse_args()
         return args
@@ -244,6 +331,52 @@ def coords(xy):
         raise argparse.ArgumentTypeError("Park Coordinates must be x,y")
 
 
+def rectangle(value):
+    """Processes rectangle for bed limits and clips
+
+    Args:
+        value (string): x0,y0,x1,y1 and optional height
+
+    Raises:
+        argparse.ArgumentTypeError: if not four or five numbers
+
+    Returns:
+        tuple: x0, y0, x1, y1, height
+    """
+    try:
+        numbers = [float(number) for number in value.split(',')]
+        x0, y0, x1, y1 = numbers[:4]
+        height = numbers[4] if len(numbers) == 5 else float('inf')
+        if len(numbers) not in (4, 5):
+            raise ValueError(value)
+        return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1), height
+    except Exception as exc:
+        print(exc.args)
+        raise argparse.ArgumentTypeError("Rectangle must be x0,y0,x1,y1 or x0,y0,x1,y1,z")
+
+
+def positive_int(value):
+    """Processes integers which must be greater than zero
+
+    Args:
+        value (string): number
+
+    Raises:
+        argparse.ArgumentTypeError: if not a whole number greater than zero
+
+    Returns:
+        int: number
+    """
+    try:
+        number = int(value)
+        if number < 1:
+            raise ValueError(value)
+        return number
+    except Exception as exc:
+        print(exc.args)
+        raise argparse.ArgumentTypeError("Value must be a whole number greater than zero")
+
+
 # replace OrcaSlicer Types with PrusaSlicer Types as well
 orca_replace = [
     ("Skirt", "Skirt/Brim"),
@@ -280,6 +413,18 @@ def main(args, conf):
 
     get_configuration(args)
 
+    # Merge all files into one, the input files stay as they are
+    if args.merge:
+        if args.nomove:
+            print('--merge needs the move to the first point of every part, --nomove is not possible.')
+            sys.exit(1)
+        for sourcefile in args.input_file:
+            if not path.exists(sourcefile):
+                print(f'File not found: {sourcefile}')
+                sys.exit(1)
+        process_gcodefile(args, args.input_file, args.merge)
+        return
+
     for sourcefile in args.input_file:
 
         # Counter: count up or down
@@ -307,7 +452,7 @@ def main(args, conf):
 
             #
             #
-            process_gcodefile(args, sourcefile)
+            process_gcodefile(args, [sourcefile], sourcefile)
 
             #
             #
@@ -349,24 +494,78 @@ def obscure_configuration(strline):
         Obscure _all_ settings
     """
     # the easy way out:
-    strline = "; = 0\n"
+    strline = b"; = 0\n"
     return strline
 
 
-def process_gcodefile(args, sourcefile):
+def progress_message(args, current_layer, number_of_layers, progress_list):
+    """ M117 message for a layer: progress bar, layer of layers or percentage
+
+    Args:
+        args: parsed arguments, --prog, --proglayer, --pchar and --pwidth
+        current_layer (int): layer number
+        number_of_layers (int): number of the last layer
+        progress_list (list): fractions and chars of a partly filled char
+
+    Returns:
+        bytes: M117 line
+    """
+    # if --prog was passed:
+    if args.prog:
+        pwidth = int(args.pwidth)
+
+        # Create progress bar on printer's display
+        # Use a different char every 0.25% progress:
+        #   Edit progress_list to get finer progress
+        filled_length = int(
+            pwidth * current_layer // number_of_layers)
+        filled_lengt_half = float(
+            pwidth * current_layer / number_of_layers - filled_length)
+        strlcase = ""
+        p2width = pwidth
+
+        if current_layer == 0:
+            strlcase = "1st Layer"
+            p2width = len(strlcase)
+        elif current_layer / number_of_layers < 1:
+            # check for percentage and insert corresponding char from progress_list
+            for prog_thing in enumerate(progress_list):
+                if filled_lengt_half >= (prog_thing[1])[0]:
+                    strlcase = (prog_thing[1])[1]
+                    p2width = pwidth - 1
+                else:
+                    break
+
+        # assemble the progressbar (M117)
+        strline = rf'M117 [{args.pchar * filled_length + strlcase + "." * (p2width - filled_length)}];' + '\n'
+
+    # if --prog was NOT passed
+    else:
+        tmppercentage = f"{((current_layer / number_of_layers) * 100):#.3g}"
+        percentage = tmppercentage[:3] \
+            if tmppercentage.endswith('.') else tmppercentage[:4]
+
+        if current_layer == 0:
+            strline = str.format(
+                'M117 First Layer' + '\n')
+        else:
+            if args.proglayer:
+                strline = str.format(
+                    'M117 Layer {0} of {1}' + '\n', current_layer + 1, number_of_layers + 1)
+            else:
+                strline = str.format(
+                    'M117 Layer {0}, {1}%' + '\n', current_layer + 1, percentage)
+
+    return strline.encode('UTF-8')
+
+
+def process_gcodefile(args, sourcefiles, destfile):
     """
         MAIN Processing.
-        To do with ever file from command line.
+        To do with ever file from command line: sourcefiles is that one file.
+        With --merge, sourcefiles are the parts to print one after another.
     """
 
-    # Read the ENTIRE GCode file into memory
-    try:
-        with open(sourcefile, "r", encoding='UTF-8') as readfile:
-            lines = readfile.readlines()
-    except ReadError as exc:
-        print('FileReadError:' + str(exc))
-        sys.exit(1)
-
     #
     # Define list of progressbar percentage and cacters
     progress_list = [[0, "."], [.25, ":"], [.5, "+"], [.75, "#"]]
@@ -380,153 +579,182 @@ def process_gcodefile(args, sourcefile):
     b_skip_removed = False
     b_start_remove_comments = True
     b_start_add_custom_info = False
-    writefile = None
+    b_config_section = False
     number_of_layers = 0
     current_layer = 0
-    is_config_comment = True
-    icount = 0
+    blocksize = args.blocksize * 1024
+    tmpfile = destfile + '.tmp'
+
+    # Parts: layers are numbered over all of them
+    part = -1
+    layer_offsets = []
+    layer_offset = 0
+    top_z = 0
+    held_lines = None
+    b_skip_start = False
+    b_hold_end = False
+    e_mode = None
+    b_end_gcode = False
 
     try:
         # Find total layers - search from back of file until
         # first "M117 Layer [num]" is found.
         # Store total number of layers.
-        # Also, measure configuration section length.
-        len_lines = len(lines)
-        for line_index in range(len_lines):
-            # start from the back
-            strline = lines[len_lines - line_index - 1]
-
-            if is_config_comment is True:
-                # Count number of lines of the configuration section
-                icount += 1
-                # find beginning of configuration section
-                if strline == "; prusaslicer_config = begin\n":
-                    is_config_comment = False
-
-            # Find last Layer:
-            rgxm117 = re.search(regex.findlayer, strline, flags=re.IGNORECASE)
-            if rgxm117:
-                # Found M117 Layer xy
-                number_of_layers = int(rgxm117.group(1))
-                break
+        for sourcefile in sourcefiles:
+            layer_offsets.append(number_of_layers + 1 if layer_offsets else 0)
+            number_of_layers = layer_offsets[-1] + find_number_of_layers(sourcefile, blocksize)
     except Exception as exc:
         print("Oops! Something went wrong in finding total numbers of layers. " + str(exc))
         sys.exit(1)
 
+    # M117 message of every layer, ready to use
+    progress_table = []
+    if number_of_layers > 0:
+        progress_table = [progress_message(args, layer, number_of_layers, progress_list)
+                          for layer in range(number_of_layers + 1)]
+
     try:
-        with open(sourcefile, "w", newline='\n', encoding='UTF-8') as writefile:
+        # Read ahead, process and write behind, all at the same time.
+        # The processed file replaces the original when done.
+        with ReaderThread(sourcefiles, blocksize, args.queuedepth) as reader, \
+                WriterThread(tmpfile, args.queuedepth) as writefile:
 
             # Store args in vars - easier to type, or change, add...
-            argprogress = args.prog
-            argprogresslayer = args.proglayer
             args_info_numlayer = args.numlayer
             argscraftwaretypes = args.craftwaretypes
             argseaseinfactor = args.easeinfactor
             argsnocuramove = args.nomove
             argsobscureconfig = args.oc
-            argsprogchar = args.pchar
             argsremoveallcomments = args.rak
             argsremovecomments = args.rk
             argsxy = args.xy
             fspeed = 3000
-            pwidth = int(args.pwidth)
-            argsorca = args.orc2ps
-
-            # obscure configuration section, if parameter submitted:
-            if argsobscureconfig:
-                len_lines = len(lines)
-                for line_index in range(len_lines):
-                    # start from the back
-                    strline = strline = lines[len_lines - line_index - 1]
-                    if strline == "; prusaslicer_config = begin\n":
-                        break
-                    if strline != "; prusaslicer_config = end\n":
-                        strline = obscure_configuration(strline)
-
-                    lines[len_lines - line_index - 1] = strline
-
-            # REMOVE configuration
-            # del lines[len(lines)-ICOUNT:len(lines)]
+            argsorca = args.orc2pstypes
+
+            # Lines are written through the optimization stage and the parser for
+            # the bed/clip check and the statistics, if requested, and then in large
+            # blocks to file: after each block read, the stages pass on what they
+            # collected, once they have enough.
+            blockwriter = output = BlockWriter(writefile, blocksize)
+            checker = None
+            stats = None
+            parser = None
+            optimizer = None
+            strfeature = None
+            if args.bed or args.clip or args.minz is not None or args.maxz is not None:
+                checker = BoundsChecker(args.bed, args.minz, args.maxz, args.clip)
+            if args.stats:
+                stats = StatsCollector(number_of_layers + 1)
+            if checker is not None or stats is not None:
+                parser = output = BatchParser(output, [consumer for consumer in (checker, stats)
+                                                       if consumer is not None])
+            if args.optimize:
+                optimizer = output = TravelOptimizer(output)
+
+            def flush():
+                """
+                    Pass on what the stages collected, once they have enough.
+                """
+                if parser is not None:
+                    parser.flush()
+                blockwriter.flush()
 
             # Loop over GCODE file
-            for i, strline in enumerate(lines):
+            for i, strline in enumerate(reader.lines(flush)):
+                if strline is None:
+                    # next file starts
+                    if part > 0 and (b_skip_start or not b_skip_all):
+                        stop_without_first_move(sourcefiles[part])
+                    if part >= 0 and b_hold_end and not b_end_gcode:
+                        print(f'Merge: warning, no end G-Code found in {sourcefiles[part]}.')
+                    held_lines = None
+                    part += 1
+                    layer_offset = layer_offsets[part]
+                    b_skip_start = part > 0
+                    e_mode = None
+                    b_hold_end = part < len(sourcefiles) - 1
+                    first_layer_height = 0
+                    b_edited_line = False
+                    b_skip_all = False
+                    b_skip_removed = False
+                    b_start_remove_comments = True
+                    b_config_section = False
+                    fspeed = 3000
+                    continue
+
                 i_line_after_edit = 0
 
+                # parts after the first: skip header and start G-Code, up to the first layer
+                if b_skip_start:
+                    if strline != b";LAYER_CHANGE\n" and not regex.rgx_firstlayerz.match(strline):
+                        if strline.startswith((b"M82", b"M83")):
+                            e_mode = strline[:3].decode('UTF-8')
+                        continue
+                    b_skip_start = False
+
+                    # what the skipped start G-Code did: lift clear of the parts printed
+                    # before, the extruder mode of this part, and reset the extrusion
+                    boundary = f'G90 ; use absolute coordinates\n' \
+                        f'G0 Z{format_float(top_z + args.clearance)} F{str(fspeed)} ; lift clear of the parts printed before\n'
+                    if e_mode is not None:
+                        boundary += f'{e_mode} ; extruder mode of the next part\n'
+                    boundary = (boundary + 'G92 E0 ; reset extrusion distance\n').encode('UTF-8')
+                    if argsremovecomments or argsremoveallcomments:
+                        boundary = strip_comments(boundary)
+                    output.write(boundary)
+
+                # parts before the last: hold back what may be end G-Code and configuration
+                if b_hold_end:
+                    if strline.startswith(b";Z:"):
+                        top_z = max(top_z, float(strline[3:]))
+                    if held_lines is None:
+                        if strline in (b";TYPE:Custom\n", b"; prusaslicer_config = begin\n"):
+                            held_lines = []
+                            b_end_gcode = strline == b";TYPE:Custom\n"
+                    elif strline == b";LAYER_CHANGE\n" or regex.rgx_layer.match(strline) \
+                            or (strline.startswith(b";TYPE:") and strline != b";TYPE:Custom\n"):
+                        # it was custom G-Code within the print
+                        for line in held_lines:
+                            output.write(line)
+                        held_lines = None
+                        b_end_gcode = False
+
+                # obscure configuration section, if parameter submitted:
+                if b_config_section:
+                    if strline != b"; prusaslicer_config = end\n":
+                        strline = obscure_configuration(strline)
+                elif argsobscureconfig and strline == b"; prusaslicer_config = begin\n":
+                    b_config_section = True
+
                 #
                 # PROGRESS-BAR in M117:
-                rgxm117 = re.search(regex.findlayer, strline,
-                                    flags=re.IGNORECASE)
-
-                # if --prog was passed:
-                if rgxm117 and argprogress:
-                    current_layer = int(rgxm117.group(1))
-
-                    # Create progress bar on printer's display
-                    # Use a different char every 0.25% progress:
-                    #   Edit progress_list to get finer progress
-                    filled_length = int(
-                        pwidth * current_layer // number_of_layers)
-                    filled_lengt_half = float(
-                        pwidth * current_layer / number_of_layers - filled_length)
-                    strlcase = ""
-                    p2width = pwidth
-
-                    if current_layer == 0:
-                        strlcase = "1st Layer"
-                        p2width = len(strlcase)
-                    elif current_layer / number_of_layers < 1:
-                        # check for percentage and insert corresponding char from progress_list
-                        for prog_thing in enumerate(progress_list):
-                            if filled_lengt_half >= (prog_thing[1])[0]:
-                                strlcase = (prog_thing[1])[1]
-                                p2width = pwidth - 1
-                            else:
-                                break
-
-                    # assemble the progressbar (M117)
-                    strline = rf'M117 [{argsprogchar * filled_length + strlcase + "." * (p2width - filled_length)}];' + '\n'
-
-                # if --prog was NOT passed
-                elif rgxm117:
-                    current_layer = int(rgxm117.group(1))
-                    tmppercentage = f"{((current_layer / number_of_layers) * 100):#.3g}"
-                    percentage = tmppercentage[:3] \
-                        if tmppercentage.endswith('.') else tmppercentage[:4]
-
-                    if current_layer == 0:
-                        strline = str.format(
-                            'M117 First Layer' + '\n')
+                rgxm117 = regex.rgx_layer.match(strline)
+                if rgxm117:
+                    current_layer = int(rgxm117.group(1)) + layer_offset
+                    if current_layer < len(progress_table):
+                        strline = progress_table[current_layer]
                     else:
-                        if argprogresslayer:
-                            strline = str.format(
-                                'M117 Layer {0} of {1}' + '\n', current_layer + 1, number_of_layers + 1)
-                        else:
-                            strline = str.format(
-                                'M117 Layer {0}, {1}%' + '\n', current_layer + 1, percentage)
+                        strline = progress_message(args, current_layer, number_of_layers, progress_list)
 
                 if strline and first_layer_height == 0:
                     # if strline and b_found_z == False and b_skip_all == False:
                     # Find: ;Z:0.2 and store first layer height value
-                    rgx1stlayer = re.search(
-                        r"^;Z:(.*)", strline, flags=re.IGNORECASE)
+                    rgx1stlayer = regex.rgx_firstlayerz.match(strline)
                     if rgx1stlayer:
                         # Found ;Z:
-                        first_layer_height = format_number(
-                            Decimal(rgx1stlayer.group(1)))
+                        first_layer_height = format_float(rgx1stlayer.group(1))
 
                 else:
                     if strline and first_layer_height != 0 and not b_skip_removed and not b_skip_all and not argsnocuramove:
                         # G1 Z.2 F7200 ; move to next layer (0)
                         # and replace with empty string
-                        layerzero = re.search(
-                            rf'^(?:G1)\s(?:(?:Z)([-+]?\d*(?:\.\d+)))\s(?:F({regex.findnumber})?)(?:.*layer \(0\).*)$',
-                            strline, flags=re.IGNORECASE)
+                        layerzero = regex.rgx_layerzero.match(strline)
                         if layerzero:
                             # Get the speed for moving to Z?
-                            fspeed = format_number(Decimal(layerzero.group(2)))
+                            fspeed = format_float(layerzero.group(2))
 
                             # clear this line, I got no use for that one!
-                            strline = ""
+                            strline = b""
 
                             b_edited_line = True
                             b_skip_removed = True
@@ -538,8 +766,7 @@ def process_gcodefile(args, sourcefile):
                     if b_start_add_custom_info is False:
                         # find first "extrusion width", to make sure we're
                         # in the info-block
-                        rgx_infoblock = re.search(
-                            r'(?:^;\s)(?:.*)(extrusion width)', line, flags=re.IGNORECASE)
+                        rgx_infoblock = regex.rgx_infoblock.match(line)
 
                         if rgx_infoblock:
                             if rgx_infoblock.group(1):
@@ -547,9 +774,9 @@ def process_gcodefile(args, sourcefile):
 
                     else:
                         # add Total Layer Count before first empty line
-                        if line == '\n':
-                            line = f'; total number of layers = {number_of_layers}\n'
-                            line += '\n'
+                        if line == b'\n':
+                            line = f'; total number of layers = {number_of_layers}\n'.encode('UTF-8')
+                            line += b'\n'
 
                             # reset, so it won't do it anymore
                             args_info_numlayer = False
@@ -561,8 +788,7 @@ def process_gcodefile(args, sourcefile):
 
                     # Day after PS changes **** again!!!!
                     # G1 X92.706 Y96.155 ; move to first skirt point
-                    m_c = re.search(
-                        rf'^((G1\sX{regex.findnumber}\sY{regex.findnumber})\s.*(?:(move to first).*(?:point)))', strline, flags=re.IGNORECASE)
+                    m_c = regex.rgx_firstpoint.match(strline)
                     if m_c:
                         # In 2.4.0b1 something changed:
                         # It was:
@@ -582,33 +808,45 @@ def process_gcodefile(args, sourcefile):
                         # G1 E6 F3000 ;  ; unretract
 
                         # Replace G1 with G0: Non extruding move
-                        grp2 = m_c.group(2).replace('G1', 'G0')
+                        grp2 = m_c.group(2).decode('UTF-8').replace('G1', 'G0')
+                        moves = ''
 
                         if argsxy:
                             # add first line to move to XY only
-                            line += f'{grp2} F{str(fspeed)}; just XY' + '\n'
+                            moves += f'{grp2} F{str(fspeed)}; just XY' + '\n'
 
                             # check height of FIRST_LAYER_HEIGHT
                             # to make ease-in a bit safer
-                            scaled_layerheight = format_number(
-                                Decimal(first_layer_height) * argseaseinfactor)
+                            # (rounded to the decimals of first layer height, like the exact product)
+                            scaled_layerheight = format_float(round(
+                                float(first_layer_height) * argseaseinfactor, len(first_layer_height.partition('.')[2])))
 
                             # Then ease-in a bit ... this always gave me a heart attack!
                             #   So, depending on first layer height, drop to 15 times (default)
                             #   first layer height in mm, ...
-                            line += f'G0 F{str(fspeed)} Z{str(scaled_layerheight)} ; ' \
+                            moves += f'G0 F{str(fspeed)} Z{str(scaled_layerheight)} ; ' \
                                 'Then Z{str(scaled_layerheight)} at normal speed' + '\n'
 
                             #   then do the final Z-move at a third of the previous speed.
-                            line += f'G0 F{str(format_number(float(fspeed)/3))} Z{str(first_layer_height)} ; ' \
+                            moves += f'G0 F{str(format_float(float(fspeed)/3))} Z{str(first_layer_height)} ; ' \
                                 'Then to first layer height at a third of previous speed\n'
 
                         else:
                             # Combined move to first skirt point.
                             # Prusa thinks driving through clips is no issue!
-                            line += f'{grp2} Z{str(first_layer_height)} F{str(fspeed)} ; ' \
+                            moves += f'{grp2} Z{str(first_layer_height)} F{str(fspeed)} ; ' \
                                 'move to first skirt/support point\n'
 
+                        line += moves.encode('UTF-8')
+
+                        if part > 0:
+                            # lifted at the start of the part: to its first point, above the parts printed before
+                            line = f'{grp2} F{str(fspeed)} ; travel to next part\n'.encode('UTF-8') + line
+
+                        # several lines now: remove their comments here, one by one
+                        if argsremovecomments or argsremoveallcomments:
+                            line = strip_comments(line)
+
                         b_edited_line = False
                         b_skip_all = True
                         b_start_remove_comments = True
@@ -617,15 +855,20 @@ def process_gcodefile(args, sourcefile):
                     strline = line
 
                 # Replace TYPES to view CGode in "other" Viewers
-                if strline.startswith(";TYPE:"):
-                    strtype = strline.replace(";TYPE:", "")
+                if strline.startswith(b";TYPE:"):
+                    strtype = strline.decode('UTF-8').replace(";TYPE:", "")
+                    if part > 0 and not b_skip_all:
+                        # it would go down to the first layer where the part before ended
+                        stop_without_first_move(sourcefiles[part])
+                    if stats is not None:
+                        strfeature = strtype.strip()
 
                     # Replace PrusaSlicer terms with CraftWare descriptions
                     # If desired.
                     if argscraftwaretypes:
                         for x_var, y_var in craft_replace:
                             if strtype.lower().strip() == str(y_var).lower().strip():
-                                strline = f";segType:{x_var}\n;TYPE:{y_var}\n"
+                                strline = f";segType:{x_var}\n;TYPE:{y_var}\n".encode('UTF-8')
                                 break
 
                     # if sliced with OrcaSlicer, replace types
@@ -633,37 +876,107 @@ def process_gcodefile(args, sourcefile):
                         for x_var, y_var in orca_replace:
                             if strtype.lower().strip() == str(x_var).lower().strip():
                                 # strline = f";TYPE:{x_var}\n;TYPE:{y_var}\n"
-                                strline = f";TYPE:{y_var}\n"
+                                strline = f";TYPE:{y_var}\n".encode('UTF-8')
                                 break
 
                 if (i + 1) > i_line_after_edit and argsremovecomments and b_start_remove_comments:
-                    if strline.startswith("; prusaslicer_config"):
+                    if strline.startswith(b"; prusaslicer_config"):
                         b_start_remove_comments = False
-                    if not strline.lstrip().startswith(';'):
+                    if not is_comment(strline):
                         # remove tabs and strip spaces as well
-                        strline = splitbychar(strline, ';').replace(
-                            '\t', '').strip() + '\n'
+                        strline = strip_comment(strline)
 
                 # Remove all lines starting with ; (comment)!
-                if argsremoveallcomments:
-                    if strline.lstrip().startswith(';') or strline.lstrip().startswith('\n'):
-                        strline = ""
+                if argsremoveallcomments and (i + 1) > i_line_after_edit:
+                    if is_comment(strline) or strline.lstrip().startswith(b'\n'):
+                        strline = b""
                     else:
                         # remove tabs and strip spaces as well
-                        strline = splitbychar(strline, ';').replace(
-                            '\t', '').strip() + '\n'
+                        strline = strip_comment(strline)
 
                 #
                 # Write line back to file
-                writefile.write(strline)
+                if held_lines is not None:
+                    held_lines.append(strline)
+                else:
+                    output.write(strline)
+
+                if rgxm117:
+                    # moves after this line belong to the new layer
+                    if parser is not None:
+                        parser.set_layer(current_layer)
+
+                if strfeature is not None:
+                    # moves after this line belong to the new feature, those
+                    # the optimization stage held back to the one before
+                    parser.set_feature(stats.feature_number(strfeature))
+                    strfeature = None
+
+            if part > 0 and (b_skip_start or not b_skip_all):
+                stop_without_first_move(sourcefiles[part])
+
+            if optimizer is not None:
+                optimizer.close()
+            if parser is not None:
+                parser.close()
+            blockwriter.close()
+
+        copymode(sourcefiles[0], tmpfile)
+        replace(tmpfile, destfile)
+
+        if stats is not None:
+            stats.write_report(args.stats)
 
     except Exception as exc:
         print("Oops! Something went wrong. " + str(exc))
         sys.exit(1)
 
     finally:
-        writefile.close()
-        readfile.close()
+        if path.exists(tmpfile):
+            remove(tmpfile)
+
+    if optimizer is not None:
+        print(f'Optimization: removed {optimizer.removed} of {optimizer.commands} commands.')
+
+    if checker is not None:
+        for message in checker.report():
+            print(message)
+        if checker.violations and args.failcheck:
+            sys.exit(1)
+
+
+def find_number_of_layers(sourcefile, blocksize):
+    """ Number of the last "M117 Layer [num]", reading the file backwards in blocks
+
+    Args:
+        sourcefile (string): G-Code file
+        blocksize (int): bytes to read at once
+
+    Returns:
+        int: number of the last layer, 0 if there is none
+    """
+    with open(sourcefile, "rb") as readfile:
+        end = readfile.seek(0, 2)
+        # start of a line, which continues in the block after
+        carry = b''
+        while end > 0:
+            start = max(0, end - blocksize)
+            readfile.seek(start)
+            chunk = readfile.read(end - start) + carry
+            end = start
+
+            # the first line may begin in the block before
+            first = 0
+            if start > 0:
+                first = min((pos for pos in (chunk.find(b'\n'), chunk.find(b'\r')) if pos >= 0),
+                            default=len(chunk))
+                carry = chunk[:first]
+            text = chunk[first:].replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+            layers = regex.rgx_layers.findall(text)
+            if layers:
+                return int(layers[-1])
+    return 0
 
 
 def splitbychar(mystring, mychar):
@@ -682,6 +995,59 @@ def splitbychar(mystring, mychar):
     return a
 
 
+def is_comment(line):
+    """ True, if line (bytes) is a comment, leading whitespace ignored
+
+    Args:
+        line (bytes): G-Code line
+
+    Returns:
+        bool: line is a comment
+    """
+    if line.isascii():
+        return line.lstrip().startswith(b';')
+    # decode only if needed: str knows more whitespace
+    return line.decode('UTF-8').lstrip().startswith(';')
+
+
+def strip_comment(line):
+    """ Remove comment, tabs and surrounding whitespace of line (bytes)
+
+    Args:
+        line (bytes): G-Code line
+
+    Returns:
+        bytes: G-Code without comment, with newline
+    """
+    if line.isascii():
+        return line.partition(b';')[0].replace(b'\t', b'').strip() + b'\n'
+    # decode only if needed: str knows more whitespace
+    return (splitbychar(line.decode('UTF-8'), ';').replace('\t', '').strip() + '\n').encode('UTF-8')
+
+
+def strip_comments(lines):
+    """ strip_comment() for each of several lines (bytes)
+
+    Args:
+        lines (bytes): G-Code lines, each with newline
+
+    Returns:
+        bytes: G-Code without comments, with newlines
+    """
+    return b''.join(strip_comment(line) for line in lines.splitlines(keepends=True))
+
+
+def stop_without_first_move(sourcefile):
+    """ Stop merging: a part after the first has no first layer with a move to its first point
+
+    Args:
+        sourcefile (string): G-Code file of the part
+    """
+    print(f'Merge: no first layer with a move to the first point found in {sourcefile}, '
+          'it needs verbose G-Code.')
+    sys.exit(1)
+
+
 # Write config file
 def write_config_file(config):
     """
@@ -728,6 +1094,25 @@ def format_number(num):
     return val
 
 
+def format_float(num):
+    """ Shortest string of a number, without exponent and trailing zeros.
+        Same as format_number, but from the float's repr instead of Decimal.
+
+    Args:
+        num (float, str or bytes): number
+
+    Returns:
+        string: number
+    """
+    val = repr(float(num))
+    if val.endswith('.0'):
+        return val[:-2]
+    if 'e' in val or 'n' in val:
+        # exponent, inf or nan: the slow way
+        return format_number(val)
+    return val
+
+
 def get_int(notint):
     """
         Whatever to INT
@@ -766,6 +1151,913 @@ def get_configuration(args):
                 'DEFAULT', 'CounterDigits', fallback=6)
 
 
+class ReaderThread(threading.Thread):
+    """
+        First stage of the pipeline.
+        Reads the files in large blocks ahead of the processing, into a
+        bounded queue: it waits, when the processing falls behind.
+    """
+
+    def __init__(self, filenames, blocksize, depth):
+        super().__init__(daemon=True)
+        self.filenames = filenames
+        self.blocksize = blocksize
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        # make room, in case it waits for the queue
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.join()
+
+    def run(self):
+        try:
+            for filename in self.filenames:
+                with open(filename, "rb") as readfile:
+                    while not self.stopped.is_set():
+                        block = readfile.read(self.blocksize)
+                        # an empty block marks the end of file
+                        self.queue.put(block)
+                        if not block:
+                            break
+        except OSError as exc:
+            self.queue.put(exc)
+
+    def blocks(self):
+        """
+            Blocks of the current file, as read.
+        """
+        while True:
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                return
+            yield block
+
+    def lines(self, flush=None):
+        """
+            Lines of all files, universal newlines, like reading in text mode.
+            None comes before the first line of each file.
+            flush() is called after the lines of each block are processed,
+            so the later stages pass on what they collected by then.
+        """
+        return chain.from_iterable(self.blocks_of_lines(flush))
+
+    def blocks_of_lines(self, flush=None):
+        """
+            Complete lines of each block.
+        """
+        for index, _ in enumerate(self.filenames):
+            yield [None]
+            # start of a line, which continues in the next block
+            carry = b''
+            for block in self.blocks():
+                data = carry + block
+                if b'\r' in data:
+                    # a CR at the end may be followed by LF in the next block
+                    end = len(data) - 1 if data.endswith(b'\r') else len(data)
+                    data = data[:end].replace(b'\r\n', b'\n').replace(b'\r', b'\n') + data[end:]
+                cut = data.rfind(b'\n') + 1
+                carry = data[cut:]
+                yield data[:cut].splitlines(keepends=True)
+                if flush is not None:
+                    flush()
+            if carry:
+                carry = carry.replace(b'\r', b'\n')
+                if index < len(self.filenames) - 1 and not carry.endswith(b'\n'):
+                    # the next file starts on a new line
+                    carry += b'\n'
+                yield [carry]
+
+
+class WriterThread(threading.Thread):
+    """
+        Last stage of the pipeline.
+        Writes the blocks from a bounded queue to file: the processing
+        waits, when writing falls behind.
+    """
+
+    def __init__(self, filename, depth):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        # None marks the end of file
+        self.queue.put(None)
+        self.join()
+        if self.error is not None and exc[0] is None:
+            raise self.error
+
+    def run(self):
+        try:
+            with open(self.filename, "wb") as writefile:
+                while True:
+                    block = self.queue.get()
+                    if block is None:
+                        break
+                    writefile.write(block)
+        except OSError as exc:
+            self.error = exc
+            # keep taking blocks, so the processing won't wait forever
+            while self.queue.get() is not None:
+                pass
+
+    def write(self, data):
+        """
+            Queue a copy of data for writing.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(bytes(data))
+
+
+class BlockWriter():
+    """
+        Last stage before the output file.
+        Collects the lines in one reusable bytearray and writes it to file
+        in large blocks, instead of one small write per line.
+    """
+
+    def __init__(self, writefile, blocksize=1 << 20):
+        self.writefile = writefile
+        self.blocksize = blocksize
+        self.buffer = bytearray()
+        # no Python call per line
+        self.write = self.buffer.extend
+
+    def flush(self, final=False):
+        """
+            Write buffer to file, once it holds a full block.
+        """
+        if final or len(self.buffer) >= self.blocksize:
+            self.writefile.write(self.buffer)
+            del self.buffer[:]
+
+    def close(self):
+        """
+            Write what's left.
+        """
+        self.flush(final=True)
+
+
+class TravelOptimizer():
+    """
+        Optimization stage between the processing loop and the output file.
+        Merges consecutive travel moves, drops moves to the current position
+        and cancels back-to-back retract/unretract pairs.
+        Extruding moves are always passed through unchanged.
+    """
+
+    def __init__(self, writefile):
+        self.writefile = writefile
+        self.commands = 0
+        self.removed = 0
+
+        # Machine state: None means 'unknown'
+        self.position = {b'X': None, b'Y': None, b'Z': None, b'E': None}
+        self.feedrate = None
+        self.absolute = True
+        self.relative_e = False
+
+        # Pending travel run: [first line, command, words, number of moves, feedrate before run]
+        self.travel = None
+        # Pending retract: [line, E distance, F word, feedrate before retract]
+        self.retract = None
+
+    def write(self, text):
+        """
+            Feed one or more lines to the optimizer.
+        """
+        for line in text.splitlines(keepends=True):
+            self.process_line(line)
+
+    def close(self):
+        """
+            Write pending moves.
+        """
+        self.flush()
+
+    def flush(self):
+        """
+            Write pending travel or retract to file.
+        """
+        if self.travel is not None:
+            line, cmd, words, count, feedrate = self.travel
+            if count > 1:
+                # one move to where the last travel ended
+                line = cmd + b''.join(b' ' + axis + words[axis] for axis in (b'X', b'Y') if axis in words)
+                if self.feedrate != feedrate:
+                    line += b' F' + words[b'F']
+                line += b'\n'
+                self.removed += count - 1
+            self.writefile.write(line)
+            self.travel = None
+
+        if self.retract is not None:
+            self.writefile.write(self.retract[0])
+            self.retract = None
+
+    def process_line(self, line):
+        """
+            Optimize a single line.
+        """
+        code = splitbychar(line, b';')
+        if code.isascii():
+            tokens = code.upper().split()
+        else:
+            # decode only if needed: str knows more whitespace
+            tokens = [token.encode('UTF-8') for token in code.decode('UTF-8').upper().split()]
+        if not tokens:
+            # empty line or comment
+            self.flush()
+            self.writefile.write(line)
+            return
+
+        self.commands += 1
+        cmd, *tokens = tokens
+        words = {token[:1]: token[1:] for token in tokens}
+        try:
+            values = {axis: float(value) for axis, value in words.items()}
+        except ValueError:
+            values = None
+
+        if cmd not in (b'G0', b'G1') or values is None or not self.absolute:
+            self.flush()
+            self.update_state(cmd, values)
+            self.writefile.write(line)
+            return
+
+        feedrate = values.get(b'F', self.feedrate)
+        axes = [axis for axis in (b'X', b'Y', b'Z') if axis in values]
+
+        # Move to the current position (or set the current feedrate again)
+        if b'E' not in values and feedrate == self.feedrate \
+                and all(values[axis] == self.position[axis] for axis in axes):
+            self.removed += 1
+            return
+
+        # Retract and unretract
+        if b'E' in values and not axes:
+            if self.retract is not None and self.travel is None \
+                    and self.cancels_retract(values[b'E']):
+                _, _, f_word, retract_feedrate = self.retract
+                self.retract = None
+                self.update_position(values)
+                self.feedrate = feedrate
+                if feedrate != retract_feedrate:
+                    # keep the feedrate for the following moves
+                    self.writefile.write(b'G1 F' + words.get(b'F', f_word) + b'\n')
+                    self.removed += 1
+                else:
+                    self.removed += 2
+                return
+
+            self.flush()
+            e_distance = values[b'E']
+            if not self.relative_e:
+                e_distance = None if self.position[b'E'] is None else values[b'E'] - self.position[b'E']
+
+            if e_distance is not None and e_distance < 0:
+                self.retract = [line, e_distance, words.get(b'F'), self.feedrate]
+            else:
+                self.writefile.write(line)
+            self.update_position(values)
+            self.feedrate = feedrate
+            return
+
+        # Travel in XY only
+        if b'E' not in values and b'Z' not in values and axes:
+            if self.retract is not None:
+                self.flush()
+            if self.travel is None:
+                self.travel = [line, cmd, {}, 0, self.feedrate]
+            self.travel[1] = cmd
+            self.travel[2].update(words)
+            self.travel[3] += 1
+            self.update_position(values)
+            self.feedrate = feedrate
+            return
+
+        # Anything else: extrusion or Z move
+        self.flush()
+        self.update_position(values)
+        self.feedrate = feedrate
+        self.writefile.write(line)
+
+    def cancels_retract(self, e_value):
+        """
+            True, if E of an unretract is undoing the pending retract.
+        """
+        e_distance = self.retract[1]
+        if self.relative_e:
+            return abs(e_value + e_distance) < 1e-9
+        return abs(self.position[b'E'] - e_distance - e_value) < 1e-9
+
+    def update_position(self, values):
+        """
+            Set position from the values of a move.
+        """
+        for axis in self.position:
+            if axis in values:
+                if axis == b'E' and self.relative_e:
+                    if self.position[b'E'] is not None:
+                        self.position[b'E'] += values[b'E']
+                else:
+                    self.position[axis] = values[axis]
+
+    def update_state(self, cmd, values):
+        """
+            Track machine state for any other command.
+        """
+        if cmd in (b'G4', b'G20', b'G21') or (cmd.startswith(b'M') and cmd not in (b'M82', b'M83')):
+            return
+        if cmd == b'G90':
+            self.absolute = True
+        elif cmd == b'G91':
+            self.absolute = False
+            self.position = dict.fromkeys(self.position)
+        elif cmd == b'M82':
+            self.relative_e = False
+        elif cmd == b'M83':
+            self.relative_e = True
+        elif cmd == b'G92' and values is not None:
+            for axis in self.position:
+                if axis in values or not values:
+                    self.position[axis] = values.get(axis, 0.0)
+        elif cmd in (b'G2', b'G3') and values is not None and self.absolute:
+            self.feedrate = values.get(b'F', self.feedrate)
+            self.update_position(values)
+        else:
+            # G28, G29, tool changes, ...: position is unknown now
+            self.position = dict.fromkeys(self.position)
+            self.feedrate = None
+
+
+class BatchParser():
+    """
+        Stage between the processing loop and the output file, for the
+        bed/clip check and the statistics. Collects the written lines,
+        writes them through and parses them in batches with NumPy, once
+        for all consumers (BoundsChecker, StatsCollector).
+    """
+
+    def __init__(self, writefile, consumers, batchsize=65536):
+        self.numpy = import_numpy()
+        self.writefile = writefile
+        self.consumers = consumers
+        self.batchsize = batchsize
+
+        # parsed values of the G-code lines, in this order: all the consumers need
+        self.axes = max((consumer.axes for consumer in consumers), key=len)
+
+        self.line_count = 0
+        self.layer = -1
+        self.feature = 0
+
+        # Machine state at the end of the last batch, NaN means 'unknown'
+        self.position = self.numpy.full(len(self.axes), self.numpy.nan)
+        self.absolute = True
+
+        # Lines written since the last batch, layer and feature changes in between
+        self.pending = []
+        self.pending_layers = []
+        self.pending_features = []
+        # no Python call per line
+        self.write = self.pending.append
+
+    def set_layer(self, layer):
+        """
+            Moves after the last written line belong to this layer.
+        """
+        self.pending_layers.append((len(self.pending), layer))
+
+    def set_feature(self, feature):
+        """
+            Moves after the last written line belong to this feature (number).
+        """
+        self.pending_features.append((len(self.pending), feature))
+
+    def flush(self):
+        """
+            Process the pending lines, once they make a full batch.
+        """
+        if len(self.pending) >= self.batchsize:
+            self.process_batch()
+
+    def close(self):
+        """
+            Process remaining lines.
+        """
+        self.process_batch()
+
+    def process_batch(self):
+        """
+            Parse the pending lines and pass them to the consumers.
+        """
+        batch = self.parse_batch()
+        if batch is None:
+            return
+
+        numpy = self.numpy
+        letters, codes, values, line_numbers, layers, features = batch
+        if not len(letters):
+            return
+
+        # only G-codes move
+        gcodes = numpy.where(letters == ord('G'), codes, -1)
+        start, end = self.track_batch(gcodes, values)
+        for consumer in self.consumers:
+            consumer.process_batch(letters, codes, values, line_numbers, layers, features, start, end)
+
+    def parse_numbers(self, text, positions, width=16):
+        """
+            Parse the numbers starting at positions of text, all at once:
+            digit by digit into an integer, divided by a power of ten.
+
+            Args:
+                text (ndarray): bytes, padded with width zeros
+                positions (ndarray): start of the numbers
+
+            Returns:
+                ndarray: numbers, NaN if there is no number
+        """
+        numpy = self.numpy
+        count = len(positions)
+        mantissa = numpy.zeros(count, dtype=numpy.int64)
+        digits = numpy.zeros(count, dtype=numpy.int64)
+        decimals = numpy.zeros(count, dtype=numpy.int64)
+        dots = numpy.zeros(count, dtype=numpy.int64)
+        negative = text[positions] == ord('-')
+        valid = numpy.ones(count, dtype=bool)
+        # still within the number
+        active = numpy.ones(count, dtype=bool)
+        for column in range(width):
+            char = text[positions + column]
+            digit = char - numpy.uint8(ord('0'))
+            is_digit = (digit <= 9) & active
+            is_dot = (char == ord('.')) & active
+            is_minus = (char == ord('-')) & active
+            mantissa = numpy.where(is_digit, mantissa * 10 + digit, mantissa)
+            digits += is_digit
+            decimals += is_digit & (dots > 0)
+            dots += is_dot
+            if column:
+                valid &= ~is_minus
+            active &= is_digit | is_dot | is_minus
+            if not active.any():
+                break
+
+        # something like X1.2.3, X- or X
+        valid &= (digits > 0) & (dots <= 1)
+        numbers = mantissa / 10.0 ** decimals
+        numbers[negative] *= -1
+        numbers[~valid] = numpy.nan
+
+        # too many digits to be exact: let float() round
+        long = numpy.flatnonzero(valid & (digits > 15))
+        if len(long):
+            numbers[long] = self.parse_strings(text, positions[long], width)
+        return numbers
+
+    def parse_strings(self, text, positions, width=16):
+        """
+            Parse the numbers starting at positions of text as strings.
+            Slower than parse_numbers(), but exact for any number of digits.
+        """
+        numpy = self.numpy
+        window = text[positions[:, None] + numpy.arange(width)]
+        # cut off at the first char which is not part of a number
+        keep = ((window >= ord('0')) & (window <= ord('9'))) | (window == ord('.')) | (window == ord('-'))
+        window[~numpy.logical_and.accumulate(keep, axis=1)] = 0
+        strings = window.view(f'S{width}').ravel()
+        strings = numpy.where(strings == b'', b'nan', strings)
+        try:
+            return strings.astype(numpy.float64)
+        except ValueError:
+            # something like X1.2.3
+            return numpy.array([float(string) if re.fullmatch(regex.findnumber.encode(), string)
+                                else numpy.nan for string in strings])
+
+    def values_per_line(self, marks, offsets, newlines, current):
+        """
+            Value of each line: the last (pending index, value) mark before it.
+
+            Returns:
+                tuple: values, value after the last line
+        """
+        numpy = self.numpy
+        if not marks:
+            return numpy.full(len(newlines), current, dtype=numpy.int64), current
+        indices, values = numpy.array(marks, dtype=numpy.int64).T
+        # a mark is at the start of a line: the line after the newlines before
+        change_lines = numpy.searchsorted(newlines, offsets[indices])
+        following = numpy.searchsorted(change_lines, numpy.arange(len(newlines)), side='right') - 1
+        return numpy.where(following >= 0, values[following], current), int(values[-1])
+
+    def parse_batch(self):
+        """
+            Write the pending lines through and parse them with NumPy.
+            Letters have to be upper case, as written by the slicers.
+
+            Returns:
+                tuple: letter (G, M or T), number, values of the axes (NaN if
+                       missing, G-codes only), line number, layer and feature
+                       of every command line; None if there are no lines
+        """
+        numpy = self.numpy
+        text = b''.join(self.pending)
+        self.writefile.write(text)
+
+        # where each pending item starts in text
+        lengths = numpy.fromiter(map(len, self.pending), dtype=numpy.int64, count=len(self.pending))
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        layer_marks, self.pending_layers = self.pending_layers, []
+        feature_marks, self.pending_features = self.pending_features, []
+        del self.pending[:]
+
+        if not text:
+            # no lines: only the last layer and feature count
+            self.layer = layer_marks[-1][1] if layer_marks else self.layer
+            self.feature = feature_marks[-1][1] if feature_marks else self.feature
+            return None
+
+        if not text.endswith(b'\n'):
+            text += b'\n'
+
+        size = len(text)
+        chars = numpy.frombuffer(text + bytes(32), dtype=numpy.uint8)
+        newlines = numpy.flatnonzero(chars[:size] == ord('\n'))
+        starts = numpy.concatenate(([0], newlines[:-1] + 1))
+        first_chars = chars[starts]
+
+        line_numbers = numpy.arange(1, len(starts) + 1) + self.line_count
+        self.line_count += len(starts)
+
+        layers, self.layer = self.values_per_line(layer_marks, offsets, newlines, self.layer)
+        features, self.feature = self.values_per_line(feature_marks, offsets, newlines, self.feature)
+
+        # command lines
+        lines = numpy.flatnonzero((first_chars == ord('G')) | (first_chars == ord('M')) | (first_chars == ord('T')))
+        codes = self.parse_numbers(chars, starts[lines] + 1)
+        lines = lines[~numpy.isnan(codes)]
+        codes = codes[~numpy.isnan(codes)].astype(numpy.int64)
+        letters = first_chars[lines]
+
+        # axis values of the G-code lines, not in comments
+        column = numpy.full(256, -1, dtype=numpy.int8)
+        column[list(self.axes)] = range(len(self.axes))
+        values = numpy.full((len(lines), len(self.axes)), numpy.nan)
+        is_axis = chars[:size] == self.axes[0]
+        for letter in self.axes[1:]:
+            is_axis |= chars[:size] == letter
+        found = numpy.flatnonzero(is_axis)
+        per_line = numpy.diff(numpy.searchsorted(found, numpy.append(starts, size)))
+        line_of_letter = numpy.repeat(numpy.arange(len(starts)), per_line)
+        row_of_line = numpy.full(len(starts), -1)
+        row_of_line[lines[letters == ord('G')]] = numpy.flatnonzero(letters == ord('G'))
+        row = row_of_line[line_of_letter]
+        # behind the first semicolon of the line: comment
+        semicolons = numpy.append(numpy.flatnonzero(chars[:size] == ord(';')), size)
+        in_comment = found > semicolons[numpy.searchsorted(semicolons, starts)][line_of_letter]
+        found, row = found[(row >= 0) & ~in_comment], row[(row >= 0) & ~in_comment]
+        values[row, column[chars[found]]] = self.parse_numbers(chars, found + 1)
+
+        return letters, codes, values, line_numbers[lines], layers[lines], features[lines]
+
+    def track_positions(self, gcodes, values):
+        """
+            Position after each G-code line, vectorized.
+            Only for absolute positioning.
+        """
+        numpy = self.numpy
+        present = ~numpy.isnan(values)
+        present[(gcodes > 3) & (gcodes != 92)] = False
+
+        # homed axes are at an unknown position
+        homed = gcodes == 28
+        values[homed, :3] = numpy.nan
+        present[homed, :3] = True
+
+        # forward fill each axis, starting with the last position of the previous batch
+        last = numpy.where(present, numpy.arange(len(gcodes))[:, None], -1)
+        numpy.maximum.accumulate(last, axis=0, out=last)
+        return numpy.where(last >= 0, numpy.take_along_axis(values, numpy.maximum(last, 0), axis=0), self.position)
+
+    def track_positions_sequential(self, gcodes, values):
+        """
+            Position after each G-code line, one by one.
+            For batches with relative positioning.
+        """
+        numpy = self.numpy
+        positions = numpy.empty_like(values)
+        position = self.position.copy()
+        for row, (gcode, value) in enumerate(zip(gcodes, values)):
+            present = ~numpy.isnan(value)
+            if gcode == 90:
+                self.absolute = True
+            elif gcode == 91:
+                self.absolute = False
+            elif gcode == 28:
+                position[:3] = numpy.nan
+            elif gcode == 92 or (gcode <= 3 and self.absolute):
+                position[present] = value[present]
+            elif gcode <= 3:
+                position[present] += value[present]
+            positions[row] = position
+        return positions
+
+    def track_batch(self, gcodes, values):
+        """
+            Start and end position of each line.
+        """
+        numpy = self.numpy
+        if self.absolute and not numpy.any(gcodes == 91):
+            positions = self.track_positions(gcodes, values.copy())
+        else:
+            positions = self.track_positions_sequential(gcodes, values)
+        start = numpy.vstack((self.position, positions[:-1]))
+        self.position = positions[-1].copy()
+        return start, positions
+
+
+class BoundsChecker():
+    """
+        Bed and clip check, fed by the BatchParser.
+        Tests the moves of each batch with NumPy against the bed and
+        Z limits and the keep-out rectangles (clips).
+    """
+
+    # values needed from the G-code lines
+    axes = b'XYZ'
+
+    def __init__(self, bed, minz, maxz, clips, maxreport=10):
+        self.numpy = import_numpy()
+        self.bed = bed
+        self.minz = minz
+        self.maxz = maxz
+        self.clips = clips
+        self.maxreport = maxreport
+
+        self.violations = 0
+        self.first_violations = []
+
+    def process_batch(self, letters, codes, values, line_numbers, layers, features, start, end):
+        """
+            Test the moves of a batch with NumPy.
+        """
+        numpy = self.numpy
+
+        # Segments of all moves with X, Y or Z; skip while XY is unknown
+        # (column by column: reducing along the short axis is slow in NumPy)
+        unknown = numpy.isnan(values)
+        is_move = (letters == ord('G')) & (codes <= 3) & ~(unknown[:, 0] & unknown[:, 1] & unknown[:, 2])
+        is_move &= ~(numpy.isnan(end[:, 0]) | numpy.isnan(end[:, 1]))
+        end = end[is_move, :3]
+        start = start[is_move, :3]
+        start = numpy.where((numpy.isnan(start[:, 0]) | numpy.isnan(start[:, 1]))[:, None], end, start)
+        # Z not known yet: assume the worst, the nozzle is on the bed
+        start[:, 2] = numpy.nan_to_num(start[:, 2])
+        end[:, 2] = numpy.nan_to_num(end[:, 2])
+        line_numbers = line_numbers[is_move]
+        layers = layers[is_move]
+        low = numpy.minimum(start, end)
+        high = numpy.maximum(start, end)
+
+        checks = []
+        if self.bed is not None:
+            # the bed is convex: both ends in, all in
+            x0, y0, x1, y1, _ = self.bed
+            checks.append(('outside of bed', (low[:, 0] < x0) | (low[:, 1] < y0) |
+                           (high[:, 0] > x1) | (high[:, 1] > y1)))
+        if self.minz is not None:
+            checks.append((f'below Z{self.minz:g}', low[:, 2] < self.minz))
+        if self.maxz is not None:
+            checks.append((f'above Z{self.maxz:g}', high[:, 2] > self.maxz))
+        for number, clip in enumerate(self.clips, 1):
+            checks.append((f'hits clip {number}', self.hits_box(start, end, low, high, clip)))
+
+        if not checks:
+            return
+
+        violation = numpy.logical_or.reduce([mask for _, mask in checks])
+        self.violations += int(violation.sum())
+
+        if len(self.first_violations) < self.maxreport:
+            for kind, mask in checks:
+                for row in numpy.flatnonzero(mask)[:self.maxreport]:
+                    self.first_violations.append(
+                        (int(line_numbers[row]), int(layers[row]), kind, tuple(end[row])))
+            self.first_violations.sort()
+            del self.first_violations[self.maxreport:]
+
+    def hits_box(self, start, end, low, high, clip):
+        """
+            Segment versus box test (Liang-Barsky) for all segments at once.
+            The box is the clip from the bed up to its height. low and high
+            are the corners of the bounding box of each segment.
+        """
+        numpy = self.numpy
+        x0, y0, x1, y1, height = clip
+
+        # only segments next to the box can hit it
+        hits = numpy.zeros(len(start), dtype=bool)
+        near = numpy.flatnonzero((high[:, 0] >= x0) & (low[:, 0] <= x1) &
+                                 (high[:, 1] >= y0) & (low[:, 1] <= y1) & (low[:, 2] <= height))
+        start = start[near]
+        end = end[near]
+        low = numpy.array([x0, y0, -numpy.inf])
+        high = numpy.array([x1, y1, height])
+
+        delta = end - start
+        inside = (start >= low) & (start <= high)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t_low = (low - start) / delta
+            t_high = (high - start) / delta
+
+        # parallel to a side: either always inside or never
+        parallel = delta == 0
+        t_enter = numpy.where(parallel, numpy.where(inside, -numpy.inf, numpy.inf), numpy.minimum(t_low, t_high))
+        t_exit = numpy.where(parallel, numpy.where(inside, numpy.inf, -numpy.inf), numpy.maximum(t_low, t_high))
+
+        t_enter = numpy.maximum(t_enter.max(axis=1), 0.0)
+        t_exit = numpy.minimum(t_exit.min(axis=1), 1.0)
+        hits[near] = t_enter <= t_exit
+        return hits
+
+    def report(self):
+        """
+            Messages for the first violations.
+        """
+        if not self.violations:
+            return []
+
+        messages = [f'Bed/clip check: {self.violations} move(s) out of limits.']
+        for line_number, layer, kind, (x, y, z) in self.first_violations:
+            where = 'start G-code' if layer < 0 else f'layer {layer}'
+            message = f'  line {line_number} ({where}): move to X{x:g} Y{y:g} Z{z:g} '
+            if messages[-1].startswith(message):
+                # same move, another limit
+                messages[-1] += f', {kind}'
+            else:
+                messages.append(message + kind)
+        if self.violations > len(self.first_violations):
+            messages.append('  ...')
+        return messages
+
+
+class StatsCollector():
+    """
+        Statistics, fed by the BatchParser.
+        Sums up extrusion, travel, moves and commands and keeps min/max Z,
+        per layer and per feature, in NumPy arrays.
+    """
+
+    # values needed from the G-code lines
+    axes = b'XYZE'
+
+    # rows of the counters
+    columns = ('extruded', 'travel', 'moves', 'commands', 'min_z', 'max_z')
+
+    def __init__(self, layers=0):
+        self.numpy = import_numpy()
+        self.relative_e = False
+        self.feature_numbers = {'': 0}
+
+        # one column per layer, the first for the start G-code, and per feature
+        self.by_layer = self.new_counters(layers + 1)
+        self.by_feature = self.new_counters(1)
+
+    def feature_number(self, name):
+        """
+            Number of the feature (;TYPE:) name; a new name gets the next one.
+        """
+        return self.feature_numbers.setdefault(name, len(self.feature_numbers))
+
+    def new_counters(self, size):
+        """
+            Empty counters for size layers or features.
+        """
+        counters = self.numpy.zeros((len(self.columns), size))
+        counters[4] = self.numpy.inf
+        counters[5] = -self.numpy.inf
+        return counters
+
+    def add_counts(self, counters, index, sums, z):
+        """
+            Add the lines to the counters of their layer or feature.
+
+            Args:
+                counters (ndarray): by_layer or by_feature
+                index (ndarray): column of each line
+                sums (ndarray): extruded, travel, moves and commands of each line
+                z (ndarray): Z of each line, NaN if none
+
+            Returns:
+                ndarray: counters, grown if needed
+        """
+        numpy = self.numpy
+        size = int(index.max()) + 1
+        if size > counters.shape[1]:
+            counters = numpy.hstack((counters, self.new_counters(size - counters.shape[1])))
+        for row, weights in enumerate(sums):
+            counters[row] += numpy.bincount(index, weights, minlength=counters.shape[1])
+        numpy.minimum.at(counters[4], index, numpy.where(numpy.isnan(z), numpy.inf, z))
+        numpy.maximum.at(counters[5], index, numpy.where(numpy.isnan(z), -numpy.inf, z))
+        return counters
+
+    def process_batch(self, letters, codes, values, line_numbers, layers, features, start, end):
+        """
+            Count the lines of a batch with NumPy.
+        """
+        numpy = self.numpy
+
+        # extruder mode of each line: last M82/M83 before it
+        modes = numpy.flatnonzero((letters == ord('M')) & ((codes == 82) | (codes == 83)))
+        relative_e = numpy.full(len(letters), self.relative_e)
+        if len(modes):
+            following = numpy.searchsorted(modes, numpy.arange(len(letters)), side='right') - 1
+            relative_e = numpy.where(following >= 0, codes[modes][following] == 83, self.relative_e)
+            self.relative_e = bool(codes[modes[-1]] == 83)
+
+        # E: length in relative mode, position in absolute mode; unknown: nothing
+        is_move = (letters == ord('G')) & (codes <= 3)
+        extruded = numpy.where(relative_e, values[:, 3], end[:, 3] - start[:, 3])
+        extruded = numpy.nan_to_num(numpy.where(is_move & ~numpy.isnan(values[:, 3]), extruded, 0))
+        distance = numpy.nan_to_num(numpy.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])) * is_move
+        printing = (extruded > 0) & (distance > 0)
+
+        sums = numpy.array([numpy.where(printing, extruded, 0), numpy.where(printing, 0, distance),
+                            is_move, numpy.ones(len(letters))])
+        z = numpy.where(is_move, end[:, 2], numpy.nan)
+
+        self.by_layer = self.add_counts(self.by_layer, layers + 1, sums, z)
+        self.by_feature = self.add_counts(self.by_feature, features, sums, z)
+
+    def rows(self):
+        """
+            Statistics of everything, of each layer and of each feature.
+
+            Returns:
+                list: (kind, name, dict of columns), only with commands
+        """
+        numpy = self.numpy
+        total = numpy.concatenate((self.by_layer[:4].sum(axis=1),
+                                   [self.by_layer[4].min(), self.by_layer[5].max()]))
+        rows = [('total', '', total)]
+        for index in numpy.flatnonzero(self.by_layer[3]):
+            rows.append(('layer', int(index) - 1, self.by_layer[:, index]))
+        names = sorted(self.feature_numbers, key=self.feature_numbers.get)
+        for index in numpy.flatnonzero(self.by_feature[3]):
+            rows.append(('feature', names[index], self.by_feature[:, index]))
+
+        result = []
+        for kind, name, counts in rows:
+            extruded, travel, moves, commands, min_z, max_z = counts.tolist()
+            result.append((kind, name, {
+                'extruded': round(extruded, 5),
+                'travel': round(travel, 3),
+                'moves': int(moves),
+                'commands': int(commands),
+                'min_z': min_z if min_z <= max_z else None,
+                'max_z': max_z if min_z <= max_z else None}))
+        return result
+
+    def write_report(self, filename):
+        """
+            Write the statistics to filename: CSV if it ends with .csv, JSON otherwise.
+        """
+        rows = self.rows()
+        with open(filename, mode='w', newline='', encoding='UTF-8') as statsfile:
+            if filename.lower().endswith('.csv'):
+                writer = csv.writer(statsfile)
+                writer.writerow(('kind', 'name') + self.columns)
+                for kind, name, counts in rows:
+                    writer.writerow([kind, name] + [counts[column] for column in self.columns])
+            else:
+                report = {'total': rows[0][2],
+                          'layers': [dict(layer=name, **counts) for kind, name, counts in rows if kind == 'layer'],
+                          'features': [dict(feature=name, **counts) for kind, name, counts in rows if kind == 'feature']}
+                # no indent: the fast encoder
+                json.dump(report, statsfile)
+                statsfile.write('\n')
+
+
 class REGEX():
     """
         Class for REGEX
@@ -775,6 +2067,18 @@ class REGEX():
         self.findnumber = r"-?\d*\.?\d+"
         self.findlayer = r"^M117 Layer (\d+)"
 
+        # compiled, for lines as bytes
+        self.rgx_layer = re.compile(self.findlayer.encode(), flags=re.IGNORECASE)
+        self.rgx_layers = re.compile(self.findlayer.encode(), flags=re.IGNORECASE | re.MULTILINE)
+        self.rgx_firstlayerz = re.compile(rb"^;Z:(.*)", flags=re.IGNORECASE)
+        self.rgx_layerzero = re.compile(
+            rf'^(?:G1)\s(?:(?:Z)([-+]?\d*(?:\.\d+)))\s(?:F({self.findnumber})?)(?:.*layer \(0\).*)$'.encode(),
+            flags=re.IGNORECASE)
+        self.rgx_infoblock = re.compile(rb'(?:^;\s)(?:.*)(extrusion width)', flags=re.IGNORECASE)
+        self.rgx_firstpoint = re.compile(
+            rf'^((G1\sX{self.findnumber}\sY{self.findnumber})\s.*(?:(move to first).*(?:point)))'.encode(),
+            flags=re.IGNORECASE)
+
 
 class PPSConfig(object):
     """